@@ -1,23 +1,47 @@
-import time
+import heapq, itertools, time
+from collections import OrderedDict
 
 class TTLStore:
     def __init__(self, maxsize=1000):
-        self.s = {}
+        self.s = OrderedDict()
         self.maxsize = maxsize
+        self._heap = []  # (exp, seq, key); seq keeps unlike keys from being compared
+        self._seq = itertools.count()
 
-    def get(self, k):
+    # `now` lets callers doing many lookups read the clock once (time.monotonic seconds)
+    def get(self, k, now=None):
         v = self.s.get(k)
         if not v:
             return None
         exp, data = v
-        if time.time() >= exp:
+        if (time.monotonic() if now is None else now) >= exp:
             self.s.pop(k, None)
             return None
+        self.s.move_to_end(k)  # mark as most recently used
         return data
 
-    def set(self, k, data, ttl):
+    def set(self, k, data, ttl, now=None):
         if ttl <= 0:
             return
-        if len(self.s) >= self.maxsize:
-            self.s.pop(next(iter(self.s)))  
-        self.s[k] = (time.time() + ttl, data)
+        now = time.monotonic() if now is None else now
+        self._sweep(now)
+        if k in self.s:
+            self.s.move_to_end(k)
+        elif len(self.s) >= self.maxsize:
+            self.s.popitem(last=False)  # evict least recently used
+        exp = int(now) + ttl
+        self.s[k] = (exp, data)
+        heapq.heappush(self._heap, (exp, next(self._seq), k))
+
+    def _sweep(self, now):
+        # drop expired entries so they don't hold capacity that LRU eviction would take from live ones
+        h = self._heap
+        while h and h[0][0] <= now:
+            exp, _, k = heapq.heappop(h)
+            v = self.s.get(k)
+            if v and v[0] == exp:  # not re-set since
+                del self.s[k]
+        # overwritten/evicted keys leave stale heap entries; rebuild before they pile up
+        if len(h) > 2 * self.maxsize:
+            self._heap = [(v[0], next(self._seq), k) for k, v in self.s.items()]
+            heapq.heapify(self._heap)
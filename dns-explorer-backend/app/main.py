@@ -1,6 +1,7 @@
 import os
 from fastapi import FastAPI, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from dotenv import load_dotenv
 
 from .resolver import DNSResolver
@@ -8,7 +9,7 @@ from .cache import TTLStore
 
 load_dotenv() 
 
-app = FastAPI(title="DNS Explorer API")
+app = FastAPI(title="DNS Explorer API", default_response_class=ORJSONResponse)
 
 allowed = os.getenv("ALLOWED_ORIGINS", "http://localhost:5173")
 allow_origins = [o.strip() for o in allowed.split(",") if o.strip()]
@@ -30,10 +31,17 @@ def healthz():
     return {"ok": True}
 
 @app.get("/resolve")
-def resolve(
+async def resolve(
     name: str = Query(...),
     type: str = Query("A"),
     cache: str = Query("on")
 ):
     use_cache = (cache == "on")
-    return resolver.resolve(name, type, use_cache)
+    # returned directly so FastAPI skips jsonable_encoder; the trace is plain JSON types
+    return ORJSONResponse(await resolver.resolve(name, type, use_cache))
+
+if __name__ == "__main__":
+    import uvicorn
+    # uvloop/httptools come with uvicorn[standard]; the walk is socket- and timer-heavy
+    uvicorn.run(app, host=os.getenv("HOST", "0.0.0.0"), port=int(os.getenv("PORT", "8000")),
+                loop="uvloop", http="httptools")
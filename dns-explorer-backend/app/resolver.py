@@ -1,38 +1,292 @@
-import random, time
+import asyncio, os, random, time
+from collections import OrderedDict
 from typing import Dict, List, Optional
-import dns.message, dns.name, dns.query, dns.rdatatype, dns.flags, dns.rcode, dns.resolver
+import dns.message, dns.name, dns.asyncquery, dns.rdatatype, dns.flags, dns.rcode, dns.asyncresolver
+import dns.opcode
+import dns.edns, dns.exception
 from .cache import TTLStore
 
 ROOTS = ["198.41.0.4","199.9.14.201","192.33.4.12","199.7.91.13","192.203.230.10",
          "192.5.5.241","192.112.36.4","198.97.190.53","192.36.148.17","192.58.128.30",
          "193.0.14.129","199.7.83.42","202.12.27.33"]
-TYPES = {"A": dns.rdatatype.A, "AAAA": dns.rdatatype.AAAA, "CNAME": dns.rdatatype.CNAME}
+RACE_WIDTH = 3  # NS IPs queried in parallel per hop
+RTT_CACHE_SIZE = 4096  # servers whose EWMA RTT is remembered
+SOCK_POOL_SIZE = 256  # idle UDP sockets kept open, one per server
+ROOT_EXPLORE = 0.1  # chance of trying a random root instead of the fastest
+WIRE_CACHE_SIZE = 1024  # encoded query templates kept per (qname, qtype)
+MAX_CNAME_CHAIN = 8  # CNAMEs followed before giving up
+NEG_TTL_CAP = 3600  # upper bound on how long an NXDOMAIN is cached
+# hot-path constants bound once instead of attribute chains per record
+_A, _AAAA, _CNAME = dns.rdatatype.A, dns.rdatatype.AAAA, dns.rdatatype.CNAME
+_NS, _SOA = dns.rdatatype.NS, dns.rdatatype.SOA
+_ADDR_TYPES = (_A, _AAAA)
+_TO_TEXT = dns.rdatatype.to_text
+_NAME_TEXT = dns.name.Name.to_text
+_NXDOMAIN = dns.rcode.NXDOMAIN
+_QR, _RD = dns.flags.QR, dns.flags.RD
+_QUERY = dns.opcode.QUERY
+# rcodes a server may send with an empty question section (as Message.is_response allows)
+_BARE_RCODES = (dns.rcode.FORMERR, dns.rcode.SERVFAIL, dns.rcode.NOTIMP, dns.rcode.REFUSED)
+TYPES = {"A": _A, "AAAA": _AAAA, "CNAME": _CNAME}
+
+_RDTYPE_TEXT: Dict[int, str] = {}  # rdtype -> mnemonic, filled on first use
+
+def _rdtype_text(rdtype: int) -> str:
+    t = _RDTYPE_TEXT.get(rdtype)
+    if t is None:
+        t = _RDTYPE_TEXT[rdtype] = _TO_TEXT(rdtype)
+    return t
 
 def _rrset(rrset):  # serialize for JSON
     return {
         "name": rrset.name.to_text(),
-        "rdtype": dns.rdatatype.to_text(rrset.rdtype),
+        "rdtype": _rdtype_text(rrset.rdtype),
         "ttl": rrset.ttl,
         "records": [{"value": r.to_text()} for r in rrset]
     }
 
+class _UDPQueue(asyncio.DatagramProtocol):
+    """Queues every datagram, so skipping a bogus reply never loses the one after it."""
+    def __init__(self):
+        self.q: asyncio.Queue = asyncio.Queue()
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.q.put_nowait(data)
+
+    def error_received(self, exc):  # e.g. ICMP port unreachable
+        self.q.put_nowait(exc)
+
+    def close(self):
+        self.transport.close()
+
+class QueryError(Exception):
+    """Every server in a race failed; `server` is the one whose error is reported."""
+    def __init__(self, server: str, err: Exception):
+        super().__init__(str(err))
+        self.server = server
+
+def _cookie_ok(sent: bytes, resp) -> bool:
+    # RFC 7873: a reply may omit COOKIE, but if present it must echo our client cookie
+    for o in resp.options:
+        if o.otype == dns.edns.OptionType.COOKIE:
+            return o.to_wire()[:8] == sent
+    return True
+
+def _is_reply(resp, wire: bytes, qname: dns.name.Name, rdtype: int) -> bool:
+    if (resp.id != int.from_bytes(wire[:2], "big") or not resp.flags & _QR
+            or resp.opcode() != _QUERY):
+        return False
+    q = resp.question
+    if not q:
+        # e.g. FORMERR from servers that don't understand our EDNS options
+        return resp.rcode() in _BARE_RCODES
+    return len(q) == 1 and q[0].name == qname and q[0].rdtype == rdtype
+
 def _glue_ips(additional) -> Dict[str, List[str]]:
     m = {}
     for rr in additional:
-        if rr.rdtype in (dns.rdatatype.A, dns.rdatatype.AAAA):
-            host = rr.name.to_text().rstrip(".")
+        if rr.rdtype in _ADDR_TYPES:
+            host = _NAME_TEXT(rr.name, omit_final_dot=True)
             ips = [getattr(r, "address", r.to_text()) for r in rr]
-            m.setdefault(host, []).extend(ips)
+            if host in m:
+                m[host].extend(ips)
+            else:
+                m[host] = ips
     return m
 
 class DNSResolver:
     def __init__(self, cache: Optional[TTLStore]=None, timeout: float=2.0):
         self.cache, self.timeout = cache, timeout
+        self._ns_cache = TTLStore(maxsize=2048)  # NS host -> addresses
+        self._system_resolver = None  # built on first glue-less NS, then shared
+        self._rtt: "OrderedDict[str, float]" = OrderedDict()  # server IP -> EWMA RTT (ms), LRU
+        self._socks: "OrderedDict[str, _UDPQueue]" = OrderedDict()  # LRU
+        self._wires: "OrderedDict[tuple, bytes]" = OrderedDict()  # LRU
+        self._inflight: Dict[tuple, asyncio.Future] = {}  # (name, qtype, use_cache) -> walk
+        self._stragglers: set = set()  # race losers still waiting on their reply
+
+    def _query_wire(self, qname: dns.name.Name, rdtype: int) -> bytes:
+        """Wire-format non-recursive query with a fresh ID and client cookie spliced in."""
+        key = (qname, rdtype)
+        tmpl = self._wires.get(key)
+        if tmpl is None:
+            cookie = dns.edns.GenericOption(dns.edns.OptionType.COOKIE, bytes(8))
+            msg = dns.message.make_query(qname, rdtype, use_edns=0, options=[cookie])
+            msg.flags &= ~_RD  # clear Recursion Desired
+            tmpl = self._wires[key] = msg.to_wire()
+            if len(self._wires) > WIRE_CACHE_SIZE:
+                self._wires.popitem(last=False)
+        else:
+            self._wires.move_to_end(key)
+        # the header ID is the first 2 bytes; the cookie is the OPT record's last 8
+        r = os.urandom(10)
+        return r[:2] + tmpl[2:-8] + r[2:]
+
+    async def _sock(self, server: str) -> _UDPQueue:
+        # borrow the server's idle socket (never shared between in-flight queries);
+        # connected, so the kernel drops datagrams from any other source
+        sock = self._socks.pop(server, None)
+        if sock is None:
+            _, sock = await asyncio.get_running_loop().create_datagram_endpoint(
+                _UDPQueue, remote_addr=(server, 53))
+        return sock
+
+    def _release(self, server: str, sock: _UDPQueue):
+        if server in self._socks:
+            sock.close()
+            return
+        self._socks[server] = sock
+        if len(self._socks) > SOCK_POOL_SIZE:
+            self._socks.popitem(last=False)[1].close()
+
+    async def _resolve_ns(self, host: str) -> List[str]:
+        # a TTL-bound memo rather than functools.lru_cache, which can't cache coroutines
+        ips = self._ns_cache.get(host)
+        if ips is not None:
+            return ips
+        if self._system_resolver is None:
+            # resolv.conf is read once; without nameservers only this fallback is lost
+            try:
+                self._system_resolver = dns.asyncresolver.Resolver()
+            except Exception:
+                return []
+            self._system_resolver.lifetime = self.timeout
+        answers = await asyncio.gather(
+            self._system_resolver.resolve(host, "A"),
+            self._system_resolver.resolve(host, "AAAA"),
+            return_exceptions=True,
+        )
+        ips, ttl = [], None
+        for ans in answers:
+            if not isinstance(ans, Exception):
+                ips += [r.address for r in ans]
+                ttl = ans.rrset.ttl if ttl is None else min(ttl, ans.rrset.ttl)
+        if ips:
+            self._ns_cache.set(host, ips, ttl)
+        return ips
+
+    def _set_rtt(self, server: str, rtt_ms: float):
+        self._rtt[server] = rtt_ms
+        self._rtt.move_to_end(server)
+        if len(self._rtt) > RTT_CACHE_SIZE:
+            self._rtt.popitem(last=False)
+
+    def _observe(self, server: str, rtt_ms: float):
+        prev = self._rtt.get(server)
+        self._set_rtt(server, rtt_ms if prev is None else 0.8*prev + 0.2*rtt_ms)
+
+    def _pick_root(self) -> str:
+        # mostly the lowest-EWMA root; unqueried roots score 0 so each gets a turn
+        if random.random() < ROOT_EXPLORE:
+            return random.choice(ROOTS)
+        return min(ROOTS, key=lambda ip: self._rtt.get(ip, 0.0))
+
+    def _rank(self, ips: List[str]) -> List[str]:
+        # fastest known servers first; never-queried ones score 0 so they get tried
+        return sorted(ips, key=lambda ip: self._rtt.get(ip, 0.0))
 
-    def resolve(self, qname: str, qtype: str, use_cache: bool) -> Dict:
+    async def _exchange(self, sock: _UDPQueue, wire: bytes, server: str, qname, rdtype):
+        q = sock.q
+        while not q.empty():
+            q.get_nowait()  # late replies to earlier, abandoned queries
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.timeout
+        sock.transport.sendto(wire)
+        while True:
+            try:
+                data = await asyncio.wait_for(q.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise dns.exception.Timeout(timeout=self.timeout) from None
+            if isinstance(data, Exception):
+                raise data
+            try:
+                resp = dns.message.from_wire(data, raise_on_truncation=True)
+            except dns.message.Truncated as e:
+                if _is_reply(e.message(), wire, qname, rdtype):
+                    return await dns.asyncquery.tcp(dns.message.from_wire(wire), server, timeout=self.timeout)
+                continue
+            except Exception:
+                continue  # unparseable datagram
+            # skip strays and, per RFC 7873, replies with a wrong cookie; queued
+            # datagrams mean the real reply is still there behind them
+            if _is_reply(resp, wire, qname, rdtype) and _cookie_ok(wire[-8:], resp):
+                return resp
+
+    async def _ask(self, wire: bytes, server: str, qname, rdtype):
+        sock = await self._sock(server)
+        t0 = time.perf_counter()
+        try:
+            resp = await self._exchange(sock, wire, server, qname, rdtype)
+        except asyncio.CancelledError:
+            sock.close()
+            raise
+        except Exception:
+            self._observe(server, self.timeout*1000)  # count failures as a full timeout
+            sock.close()
+            raise
+        self._release(server, sock)
+        rtt = round((time.perf_counter()-t0)*1000,2)
+        self._observe(server, rtt)
+        return server, resp, rtt
+
+    async def _race(self, wire: bytes, servers: List[str], qname, rdtype):
+        """Query servers concurrently; return the first (server, resp, rtt) to succeed."""
+        tasks = {asyncio.ensure_future(self._ask(wire, s, qname, rdtype)): s for s in servers}
+        pending, err = set(tasks), None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    if t.exception() is None:
+                        return t.result()
+                    err = QueryError(tasks[t], t.exception())
+        finally:
+            # let race losers finish so their real RTT, or a timeout penalty,
+            # lands in the EWMA; cancelling them would leave dead servers unscored
+            for t in pending:
+                self._stragglers.add(t)
+                t.add_done_callback(self._straggler_done)
+        raise err
+
+    def _straggler_done(self, t: asyncio.Future):
+        self._stragglers.discard(t)
+        if not t.cancelled():
+            t.exception()  # already scored in _ask; just mark it retrieved
+
+    def _start(self, name: dns.name.Name, use_cache: bool):
+        """Deepest cached delegation above name as (zone, ns_ips); falls back to a root."""
+        if use_cache and self.cache:
+            now = time.monotonic()
+            # keyed by label tuples: most probes miss, and a tuple slice is far
+            # cheaper than Name.parent() + str() for every ancestor
+            labels = name.labels
+            for i in range(len(labels) - 1):
+                ips = self.cache.get(("REFERRAL", labels[i:]), now)
+                if ips:
+                    return dns.name.Name(labels[i:]), self._rank(ips)
+        return dns.name.root, [self._pick_root()]
+
+    async def resolve(self, qname: str, qtype: str, use_cache: bool) -> Dict:
         if qtype not in TYPES: raise ValueError("Only A, AAAA, CNAME supported in MVP")
         name = dns.name.from_text(qname)
         if not name.is_absolute(): name = name.concatenate(dns.name.root)
+        # lowercase once: every cache/flight key below is case-sensitive
+        name = name.canonicalize()
+
+        # coalesce identical in-flight lookups onto one walk; shield it so one
+        # caller going away doesn't cancel the answer for the others
+        flight = (str(name), qtype, use_cache)
+        task = self._inflight.get(flight)
+        if task is None:
+            task = self._inflight[flight] = asyncio.ensure_future(self._resolve(name, qtype, use_cache))
+            task.add_done_callback(lambda _: self._inflight.pop(flight, None))
+        return await asyncio.shield(task)
+
+    async def _resolve(self, name: dns.name.Name, qtype: str, use_cache: bool) -> Dict:
         key = (str(name), qtype)
 
         # serve from cache if allowed and present
@@ -46,121 +300,146 @@ class DNSResolver:
                               "answer":c["answer"],"additional":[],"rtt_ms":0,"cached":True}],
                     "cname_chain": c["cname_chain"]
                 }
+            # negative cache: a recent NXDOMAIN for this name/type
+            n = self.cache.get(("NEG", key))
+            if n:
+                return {
+                    "query":{"name":str(name),"type":qtype,"cache":"on"},
+                    "summary":{"final_ips":None,"total_ms":0,"hops":1,"cache_saved_ms":n["ms"]},
+                    "trace":[{"step":1,"server":"cache","role":"cache","question":{"name":str(name),"type":qtype},
+                              "answer":[],"additional":[],"rtt_ms":0,"cached":True,"rcode":"NXDOMAIN"}],
+                    "cname_chain": n["cname_chain"]
+                }
 
         trace, cname_chain = [], []
         hop_id = 0   
         start_total = time.perf_counter()
         current = name
-        ns_ips = [random.choice(ROOTS)]
+        zone, ns_ips = self._start(current, use_cache)
         rdtype = TYPES[qtype]
-        final_rrsets = []
+        final_rrsets, final_hop = [], None
+        seen_names = {name}  # for CNAME loop detection
+        neg_ttl = 0
         steps = 0
 
         while steps < 25:
             steps += 1 
-            server = ns_ips[0]
+            batch = ns_ips[:RACE_WIDTH]
 
             # build a NON-RECURSIVE query (iterative)
-            msg = dns.message.make_query(current, rdtype, use_edns=True)
-            msg.flags &= ~dns.flags.RD  # clear Recursion Desired
+            wire = self._query_wire(current, rdtype)
 
-            # send UDP DNS query to that server
-            t0 = time.perf_counter()
+            # send UDP DNS query to the best few servers at once, first answer wins
             try:
-                resp = dns.query.udp(msg, server, timeout=self.timeout)
-            except Exception as e:
-                if len(ns_ips) > 1:
-                    ns_ips = ns_ips[1:]       # try another IP from referral
+                server, resp, rtt = await self._race(wire, batch, current, rdtype)
+            except QueryError as e:
+                if len(ns_ips) > len(batch):
+                    ns_ips = ns_ips[len(batch):]       # try other IPs from referral
                     continue
 
                 hop_id += 1 
                 # record the error and reset to a new root server
-                trace.append({"step":hop_id,"server":server,"role":"ns",
+                trace.append({"step":hop_id,"server":e.server,"role":"ns",
                               "question":{"name":str(current),"type":qtype},
                               "answer":[],"additional":[],"rtt_ms":None,"cached":False,"error":str(e)})
-                ns_ips = [random.choice(ROOTS)]
+                zone, ns_ips = dns.name.root, [self._pick_root()]
                 continue
 
-            
-            rtt = round((time.perf_counter()-t0)*1000,2)
             hop_id += 1 
             hop = {
                 "step": hop_id,
                 "server": server,
                 "role": "ns",
                 "question": {"name": str(current), "type": qtype},
-                "answer": [ _rrset(a) for a in resp.answer ],
-                "additional": [ _rrset(a) for a in resp.additional ],
-                "authority": [
-                    {
-                        "name": auth.name.to_text(),
-                        "rdtype": dns.rdatatype.to_text(auth.rdtype),
-                        "ttl": auth.ttl,
-                        "records": [{ "value": r.to_text() } for r in auth]
-                    } for auth in resp.authority
-                ],
+                # raw rrsets; serialized once the walk is done
+                "answer": resp.answer,
+                "additional": resp.additional,
+                "authority": resp.authority,
                 "rtt_ms": rtt,
                 "cached": False
             }
             trace.append(hop)
 
 
-            if resp.rcode() == dns.rcode.NXDOMAIN:
+            if resp.rcode() == _NXDOMAIN:
+                # RFC 2308: negative TTL is min(SOA TTL, SOA MINIMUM)
+                for auth in resp.authority:
+                    if auth.rdtype == _SOA:
+                        neg_ttl = min(auth.ttl, auth[0].minimum, NEG_TTL_CAP)
+                        break
                 break
 
             # If we got an answer section:
             if resp.answer:
                 # terminal? (contains requested rdtype)
                 if any(a.rdtype == rdtype for a in resp.answer):
-                    final_rrsets = hop["answer"]
+                    final_rrsets, final_hop = hop["answer"], hop
                     break
                 # otherwise follow CNAME: change the current name, restart from root
-                for a in resp.answer:
-                    if a.rdtype == dns.rdatatype.CNAME:
-                        target = a[0].target
-                        cname_chain.append(target.to_text().rstrip("."))
-                        current = target
-                        ns_ips = [random.choice(ROOTS)]
+                cname = next((a for a in resp.answer if a.rdtype == _CNAME), None)
+                if cname is not None:
+                    target = cname[0].target.canonicalize()
+                    if target in seen_names:
+                        hop["error"] = f"CNAME loop at {target}"
+                        break
+                    if len(cname_chain) >= MAX_CNAME_CHAIN:
+                        hop["error"] = f"CNAME chain longer than {MAX_CNAME_CHAIN}"
                         break
-                else:
-                    # no terminal A/AAAA and no CNAME → fall through to referral handling
-                    pass
+                    seen_names.add(target)
+                    cname_chain.append(_NAME_TEXT(target, omit_final_dot=True))
+                    current = target
+                    zone, ns_ips = self._start(current, use_cache)
+                    continue
+                # no terminal A/AAAA and no CNAME → fall through to referral handling
 
             # Referral: find next nameserver IPs from authority NS + additional glue
             glue = _glue_ips(resp.additional)
-            next_ips = []
+            next_ips, seen, missing = [], set(), []  # next_ips de-duped in order via seen
+            cut = None
             for auth in resp.authority:
-                if auth.rdtype == dns.rdatatype.NS:
+                if auth.rdtype == _NS:
+                    if cut is None:
+                        cut, cut_ttl = auth.name, auth.ttl
                     for rr in auth:
-                        host = rr.target.to_text().rstrip(".")
+                        host = _NAME_TEXT(rr.target, omit_final_dot=True)
                         if host in glue:
-                            next_ips += glue[host]  # use glue A/AAAA
+                            for ip in glue[host]:  # use glue A/AAAA
+                                if ip not in seen:
+                                    seen.add(ip)
+                                    next_ips.append(ip)
                         else:
-                            # fallback: resolve the NS host via system resolver (recursive)
-                            try:
-                                for r in dns.resolver.resolve(host, "A"):
-                                    next_ips.append(r.address)
-                            except Exception:
-                                pass
-                            try:
-                                for r in dns.resolver.resolve(host, "AAAA"):
-                                    next_ips.append(r.address)
-                            except Exception:
-                                pass
-            # de-dupe while preserving order
-            next_ips = list(dict.fromkeys(next_ips))
+                            missing.append(host)
+            if missing:
+                # fallback: resolve glue-less NS hosts via system resolver, all at once
+                for ips in await asyncio.gather(*(self._resolve_ns(h) for h in missing)):
+                    for ip in ips:
+                        if ip not in seen:
+                            seen.add(ip)
+                            next_ips.append(ip)
             if not next_ips:
                 break
-            ns_ips = next_ips
+            # remember the delegation, but only if it's in-bailiwick for the server we asked
+            if (use_cache and self.cache and cut != zone
+                    and cut.is_subdomain(zone) and current.is_subdomain(cut)):
+                self.cache.set(("REFERRAL", cut.canonicalize().labels), next_ips, cut_ttl)
+            zone = cut
+            ns_ips = self._rank(next_ips)
 
         total_ms = round((time.perf_counter()-start_total)*1000,2)
 
-        # Extract final IPs (best-effort parse of "A"/"AAAA" answers)
+        # Extract final IPs from the A/AAAA answers
         final_ips = []
         for rr in final_rrsets:
-            if rr["rdtype"] in ("A","AAAA"):
-                for r in rr["records"]:
-                    final_ips.append(r["value"].split(" ")[0])
+            if rr.rdtype in _ADDR_TYPES:
+                final_ips += [r.address for r in rr]
+
+        # JSON-ready trace, built off the hot path
+        for hop in trace:
+            for section in ("answer", "additional", "authority"):
+                if section in hop:
+                    hop[section] = [_rrset(a) for a in hop[section]]
+        if final_hop is not None:
+            final_rrsets = final_hop["answer"]  # already serialized with the trace
 
         # Store in cache using MIN TTL of the rrsets
         if final_rrsets and use_cache and self.cache:
@@ -170,6 +449,8 @@ class DNSResolver:
                 {"answer": final_rrsets, "final_ips": final_ips, "cname_chain": cname_chain, "ms": total_ms},
                 min_ttl
             )
+        elif neg_ttl and use_cache and self.cache:
+            self.cache.set(("NEG", key), {"nxdomain": True, "cname_chain": cname_chain, "ms": total_ms}, neg_ttl)
 
         return {
             "query":{"name":str(name),"type":qtype,"cache":"on" if use_cache else "off"},